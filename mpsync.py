@@ -7,18 +7,48 @@ Author: Thilo Michael (uhlomuhlo@gmail.com)
 
 import time
 import argparse
+import asyncio
+import binascii
+import hashlib
 import os
+import stat
 import sys
-import queue
 import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-import mp.mpfshell as mpf
+from mp.pyboard import PyboardError
 
 from watchdog.observers import Observer
-from watchdog.events import PatternMatchingEventHandler
+from watchdog.events import FileSystemEventHandler
+import watchdog.utils
 
 
-class MPSync(threading.Thread):
+class _ConnectionLost(Exception):
+    """Raised when the connection to the board broke during a batch."""
+
+
+class _Handler(FileSystemEventHandler):
+    """Forwards the watchdog events to an MPSync instance."""
+
+    def __init__(self, mps):
+        super().__init__()
+        self.mps = mps
+
+    def on_created(self, event):
+        self.mps._on_created(event)
+
+    def on_deleted(self, event):
+        self.mps._on_deleted(event)
+
+    def on_moved(self, event):
+        self.mps._on_moved(event)
+
+    def on_modified(self, event):
+        self.mps._on_modified(event)
+
+
+class MPSync:
     """
     The class that handles the the synchronizing between the folder and the MicroPython
     board.
@@ -33,50 +63,277 @@ class MPSync(threading.Thread):
     """Time to wait after filesystem changes before uploading begins."""
     WAITING_TIME = 0.5
 
-    def __init__(self, folder=".", port="/dev/tty.SLAB_USBtoUART", verbose=False):
-        super().__init__()
+    """Time without changes after which the connection to the board is closed."""
+    IDLE_TIME = 30
+
+    """Time in which repeated modifications of the same file are reported only once."""
+    DEBOUNCE_TIME = 0.1
+
+    """Number of events that are queued before they get merged per path."""
+    MAX_QUEUE_SIZE = 4096
+
+    """Names of files and folders that are never synchronized."""
+    IGNORED_DIRS = {".git", "__pycache__", ".venv", "node_modules"}
+
+    """Endings of temporary files that are never synchronized."""
+    IGNORED_SUFFIXES = (".swp", ".tmp", "~")
+
+    """Number of bytes mpfs sends to the board per command while uploading a file."""
+    CHUNK_SIZE = 256
+
+    """Files up to this size are bundled and written with a single command."""
+    SMALL_FILE_SIZE = 2048
+
+    """Number of bytes after which a bundle of small files is sent to the board."""
+    BUNDLE_SIZE = 4096
+
+    """Size of the serial read and write buffers (only supported on Windows)."""
+    SERIAL_BUFFER_SIZE = 8192
+
+    def __init__(
+        self,
+        folder=".",
+        port="/dev/tty.SLAB_USBtoUART",
+        baud=115200,
+        verbose=False,
+        ignore=(),
+    ):
         self.folder = folder
+        self._root = os.path.abspath(folder)
+        self.ignored = self.IGNORED_DIRS | set(ignore)
         self.port = port
-        self.mpfs = mpf.MpFileShell()
+        self.baud = baud
         self.verbose = verbose
-        if not verbose:
-            self.mpfs._MpFileShell__error = lambda x: None
+        # Importing and creating the mpfshell takes a while, do it in the background
+        self.mpfs = None
+        self._init_error = None
+        self._init_thread = threading.Thread(target=self._bg_init, daemon=True)
+        self._init_thread.start()
         self.wd = None
-        self._q = queue.Queue()
-        self._running = False
+        self._loop = asyncio.new_event_loop()
+        # Before Python 3.10 an asyncio.Queue is bound to the loop it is created in
+        self._q = self._loop.run_until_complete(self._create_queue())
+        self._overflow = None
+        self._task = None
+        self._worker = threading.Thread(target=self._loop.run_forever, daemon=True)
+        # mpfs is not thread-safe, so all blocking board I/O goes through one thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
         self._ts = 0
+        self._last_activity = 0
+        self._last_event_ts = {}
+        self._created_folders = set()
+        self._uploads = []
+        self._digests = {}
         self._create_watchdog()
 
+    def _bg_init(self):
+        try:
+            import mp.mpfshell as mpf
+
+            mpfs = mpf.MpFileShell()
+        except Exception as e:
+            self._init_error = e
+            return
+        if not self.verbose:
+            mpfs._MpFileShell__error = lambda x: None
+        self.mpfs = mpfs
+
+    def _shell(self):
+        """Returns mpfs once the background initialization is done."""
+        self._init_thread.join()
+        if self._init_error is not None:
+            raise RuntimeError("Could not set up mpfshell") from self._init_error
+        return self.mpfs
+
+    def _rel(self, path):
+        """Returns the path on the board for a path inside the synchronized folder."""
+        return "/" + os.path.relpath(path, self._root).replace(os.sep, "/")
+
+    def _io_error(self, msg, e):
+        """Handles a failed operation on the board. Errors the board reported for the
+        operation are only printed in verbose mode. If the connection itself broke,
+        e.g. because the board was unplugged, it is closed and _ConnectionLost is
+        raised, so the batch gets retried after reconnecting."""
+        if self.verbose:
+            print(f"{msg}: {e}")
+        if not self._is_connection_error(e):
+            return
+        try:
+            self._mpdisconnect()
+        except IOError:
+            # Closing the dead port can fail as well, drop the connection anyway
+            self.mpfs.fe = None
+        raise _ConnectionLost(msg) from e
+
+    @staticmethod
+    def _is_connection_error(e):
+        # Already imported by mpfshell, so this is only a lookup
+        from mp.mpfexp import RemoteIOError
+
+        if isinstance(e, RemoteIOError):
+            return False
+        # Exceptions raised by the code executed on the board
+        if isinstance(e, PyboardError) and e.args[:1] == ("exception",):
+            return False
+        return True
+
     def _copy_file(self, file):
-        dst = file.replace(self.folder, "")
+        """Queues a file for the next call of _copy_files_batch."""
+        dst = self._rel(file)
+        self._uploads.append((file, dst))
+
+    def _copy_files_batch(self, files):
+        """Uploads a list of (source, destination) tuples. The file explorer stays in
+        raw REPL mode for the whole connection, so the files are written directly
+        through it instead of going through the mpfshell command parsing of every
+        single do_put. Small files are bundled, so that several of them are written
+        with one raw REPL command."""
+        bundle = []
+        bundle_size = 0
+        for src, dst in files:
+            try:
+                if os.path.getsize(src) <= self.SMALL_FILE_SIZE:
+                    with open(src, "rb") as f:
+                        data = f.read()
+                    digest = hashlib.sha256(data).digest()
+                else:
+                    data = None
+                    digest = self._digest(src)
+            except OSError:
+                continue
+            if self._digests.get(src) == digest:
+                if self.verbose:
+                    print(f"Unchanged {dst}")
+                continue
+
+            if data is None:
+                self._put_file(src, dst, digest)
+                continue
+            if bundle and bundle_size + len(data) > self.BUNDLE_SIZE:
+                self._put_bundle(bundle)
+                bundle = []
+                bundle_size = 0
+            bundle.append((src, dst, data, digest))
+            bundle_size += len(data)
+        if bundle:
+            self._put_bundle(bundle)
+
+    def _put_file(self, src, dst, digest):
         print(f"Copying {dst}")
-        self.mpfs.do_put(f"{file} {dst}")
+        try:
+            self.mpfs.fe.put(src, dst)
+        except (IOError, PyboardError) as e:
+            self._io_error(f"Could not copy {dst}", e)
+            return
+        self._digests[src] = digest
+
+    def _put_bundle(self, bundle):
+        """Writes a list of small (source, destination, data, digest) files with a
+        single raw REPL command. If that fails, the files are uploaded one by one."""
+        if len(bundle) == 1:
+            src, dst, data, digest = bundle[0]
+            self._put_file(src, dst, digest)
+            return
+
+        lines = []
+        for src, dst, data, digest in bundle:
+            hexdata = binascii.hexlify(data).decode("ascii")
+            lines.append(
+                f"f = open({dst!r}, 'wb'); f.write(ubinascii.unhexlify({hexdata!r})); "
+                "f.close()"
+            )
+        try:
+            self.mpfs.fe.exec_("\n".join(lines))
+        except (IOError, PyboardError) as e:
+            self._io_error("Could not copy bundled files", e)
+            for src, dst, data, digest in bundle:
+                self._put_file(src, dst, digest)
+            return
+        for src, dst, data, digest in bundle:
+            print(f"Copying {dst}")
+            self._digests[src] = digest
+
+    @staticmethod
+    def _digest(file):
+        """Returns the SHA-256 digest of a local file."""
+        h = hashlib.sha256()
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+        return h.digest()
 
     def _create_folder(self, folder):
-        dst = folder.replace(self.folder, "")
+        dst = self._rel(folder)
+        if dst in self._created_folders:
+            return
         print(f"Creating folder {dst}")
-        self.mpfs.do_mkdir(dst)
+        try:
+            self.mpfs.fe.md(dst)
+        except (IOError, PyboardError) as e:
+            self._io_error(f"Could not create folder {dst}", e)
+            return
+        self._created_folders.add(dst)
 
     def _delete(self, path):
-        dst = path.replace(self.folder, "")
+        dst = self._rel(path)
         print(f"Deleting {dst}")
-        self.mpfs.do_rm(dst)
+        try:
+            self.mpfs.fe.rm(dst)
+        except (IOError, PyboardError) as e:
+            self._io_error(f"Could not delete {dst}", e)
+        self._created_folders = {
+            f for f in self._created_folders if f != dst and not f.startswith(dst + "/")
+        }
+        prefix = os.path.join(path, "")
+        self._digests = {
+            f: d
+            for f, d in self._digests.items()
+            if f != path and not f.startswith(prefix)
+        }
+
+    async def _create_queue(self):
+        return asyncio.Queue(maxsize=self.MAX_QUEUE_SIZE)
+
+    def _enqueue(self, action, params):
+        """Puts an action into the queue. Called from the watchdog thread."""
+        self._ts = time.monotonic()
+        self._loop.call_soon_threadsafe(self._put, (action, params))
+
+    def _put(self, item):
+        """Puts an item into the queue. If the queue is full, e.g. because the board is
+        unreachable, further actions are merged into a dict with one operation per
+        path until the worker drains both."""
+        if self._overflow is None:
+            try:
+                self._q.put_nowait(item)
+                return
+            except asyncio.QueueFull:
+                print("Too many pending changes, merging them per path")
+                self._overflow = {}
+        self._merge(self._overflow, *item)
+
+    def is_ignored(self, path):
+        """Checks whether a path is a temporary file or lies in an ignored folder."""
+        if path.endswith(self.IGNORED_SUFFIXES):
+            return True
+        parts = os.path.relpath(path, self._root).split(os.sep)
+        return not self.ignored.isdisjoint(parts)
 
     def _on_created(self, event):
-        self._q.put(("CREATE", event.src_path))
-        self._ts = time.time()
+        if not self.is_ignored(event.src_path):
+            self._enqueue("CREATE", event.src_path)
 
-    def perform_create(self, src_path):
+    def perform_create(self, src_path, kind):
         if self.verbose:
             print(f"PERFORMING create {src_path}")
-        if os.path.isfile(src_path):  # FILE
+        if kind == "file":
             self._copy_file(src_path)
-        elif os.path.isfolder(src_path):  # FOLDER
+        elif kind == "dir":
             self._create_folder(src_path)
 
     def _on_deleted(self, event):
-        self._q.put(("DELETE", event.src_path))
-        self._ts = time.time()
+        if not self.is_ignored(event.src_path):
+            self._enqueue("DELETE", event.src_path)
 
     def perform_delete(self, src_path):
         if self.verbose:
@@ -84,33 +341,91 @@ class MPSync(threading.Thread):
         self._delete(src_path)
 
     def _on_moved(self, event):
-        self._q.put(("MOVE", (event.src_path, event.dest_path)))
-        self._ts = time.time()
-
-    def perform_move(self, src_path, dst_path):
-        if self.verbose:
-            print("PERFORMING move")
-        if os.path.isfile(dst_path):
-            self._delete(src_path)
-            self._copy_file(dst_path)
-        else:
-            print("Moving folders not (yet) supported!")
+        # Editors often save by moving a temporary file over the original
+        src_ignored = self.is_ignored(event.src_path)
+        dst_ignored = self.is_ignored(event.dest_path)
+        if not src_ignored and not dst_ignored:
+            self._enqueue("MOVE", (event.src_path, event.dest_path))
+        elif not dst_ignored:
+            self._enqueue("CREATE", event.dest_path)
+        elif not src_ignored:
+            self._enqueue("DELETE", event.src_path)
 
     def _on_modified(self, event):
-        self._q.put(("MODIFY", event.src_path))
-        self._ts = time.time()
+        path = event.src_path
+        if self.is_ignored(path):
+            return
+        now = time.monotonic()
+        last = self._last_event_ts.get(path, 0)
+        self._last_event_ts[path] = now
+        if now - last < self.DEBOUNCE_TIME:
+            # Already queued, but keep postponing the upload until writing is done
+            self._ts = now
+            return
+        self._enqueue("MODIFY", path)
 
-    def perform_modify(self, src_path):
+    def perform_modify(self, src_path, kind):
         if self.verbose:
             print("PERFORMING modify")
-        if os.path.isfile(src_path):
+        if kind == "file":
             self._copy_file(src_path)
 
+    @staticmethod
+    def _kind(path):
+        """Returns whether path is a 'file' or a 'dir', or 'gone' if it is neither."""
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            return "gone"
+        if stat.S_ISREG(mode):
+            return "file"
+        if stat.S_ISDIR(mode):
+            return "dir"
+        return "gone"
+
+    def _collapse(self, actions):
+        """Collapses a list of queued actions into at most one operation per path.
+
+        Repeated CREATE/MODIFY events on a path result in a single upload, a DELETE
+        supersedes everything that happened to the path before, and a MOVE is split
+        into a DELETE of the source and a CREATE of the destination. Paths keep the
+        position of their first event so folders are still created before their
+        contents."""
+        ops = {}
+        for action, params in actions:
+            self._merge(ops, action, params)
+        return ops
+
+    @staticmethod
+    def _merge(ops, action, params):
+        """Merges a single queued action into a dict of operations per path."""
+        if action == "MOVE":
+            src_path, dst_path = params
+            ops.pop(src_path, None)
+            ops[src_path] = "DELETE"
+            ops[dst_path] = "CREATE"
+        elif action == "DELETE":
+            ops.pop(params, None)
+            ops[params] = "DELETE"
+        elif action == "CREATE" or ops.get(params) != "CREATE":
+            ops[params] = action
+
+    def _is_open(self):
+        """Returns whether mpfs is connected to the board. This only checks for a
+        file explorer, the connection itself is not probed."""
+        self._init_thread.join()
+        if self._init_error is not None:
+            return False
+        return self.mpfs.fe is not None
+
     def _mpconnect(self):
         """Connects to a micropython board. This has to be called before copying files
         to the board."""
-        if self.mpfs._MpFileShell__is_open():
-            return True
+        if self._is_open():
+            if os.path.exists(self.port):
+                return True
+            # The board went away while the connection was kept open
+            self._mpdisconnect()
 
         p = self.port
         if not os.path.exists(p) or os.path.isdir(p):
@@ -118,23 +433,40 @@ class MPSync(threading.Thread):
             return False
 
         for i in range(self.CONNECT_TRIES):
-            self.mpfs.do_open(f"{self.MPF_PROTOCOL}:{p}")
-            if self.mpfs._MpFileShell__is_open():
+            self._shell().do_open(f"{self.MPF_PROTOCOL}:{p},{self.baud}")
+            if self._is_open():
+                self._tune_connection()
+                # There might be a different board at the port now
+                self._created_folders = set()
+                self._digests = {}
                 return True
 
         print(f"Could not connect to board {p}!")
         return False
 
+    def _tune_connection(self):
+        """Enlarges the upload chunks and the serial buffers of a fresh connection."""
+        fe = self.mpfs.fe
+        if hasattr(fe, "BIN_CHUNK_SIZE"):
+            fe.BIN_CHUNK_SIZE = self.CHUNK_SIZE
+
+        serial = getattr(fe.con, "serial", None)
+        if serial is None:
+            return
+        if hasattr(serial, "set_buffer_size"):
+            size = self.SERIAL_BUFFER_SIZE
+            serial.set_buffer_size(rx_size=size, tx_size=size)
+
     def _mpdisconnect(self):
         """Disconnectes from the board. Has to be called to soft-reset the board.
-        Preferrably after every upload."""
-        if not self.mpfs._MpFileShell__is_open():
+        Happens after the connection was idle for IDLE_TIME seconds."""
+        if not self._is_open():
             return
 
         self.mpfs.do_close("")
 
-        if self.mpfs._MpFileShell__is_open():
-            print(f"Could not close connection to board {p}!")
+        if self._is_open():
+            print(f"Could not close connection to board {self.port}!")
 
     def _create_watchdog(self):
         """Creates a watchdog on everything in the specified folder."""
@@ -145,52 +477,135 @@ class MPSync(threading.Thread):
             print(f"Path '{f}' does not exist or is not a folder!")
             sys.exit(1)
 
-        # Create a Watchdog on the folder
-        eh = PatternMatchingEventHandler("*", "", False, False)  # match everything
-        eh.on_created = self._on_created
-        eh.on_modified = self._on_modified
-        eh.on_moved = self._on_moved
-        eh.on_deleted = self._on_deleted
-        self.wd = Observer()
-        self.wd.schedule(eh, f, recursive=True)
-
-    def run(self):
+        # Create a Watchdog on the folder. On Linux it has to use inotify, watchdog
+        # would silently fall back to the PollingObserver which stats the whole
+        # folder over and over again.
+        observer = Observer
+        if sys.platform.startswith("linux"):
+            # watchdog 5.0 renamed UnsupportedLibc to UnsupportedLibcError
+            unsupported_libc = getattr(watchdog.utils, "UnsupportedLibcError", None)
+            if unsupported_libc is None:
+                unsupported_libc = watchdog.utils.UnsupportedLibc
+            try:
+                from watchdog.observers.inotify import InotifyObserver as observer
+            except (ImportError, unsupported_libc):
+                print("inotify is not available, refusing to poll the folder!")
+                sys.exit(1)
+
+        self.wd = observer()
+        self.wd.schedule(_Handler(self), f, recursive=True)
+
+    def _blocking(self, func, *args):
+        """Runs a blocking function in the executor and returns an awaitable."""
+        return self._loop.run_in_executor(self._executor, func, *args)
+
+    def _process(self, ops):
+        """Performs the collapsed operations of a batch on the board. Every path is
+        stat'ed only once. Deletions run last and deepest path first, so a moved or
+        removed folder is already empty when it gets deleted."""
+        deletes = []
+        for path, action in ops.items():
+            if action == "CREATE":
+                self.perform_create(path, self._kind(path))
+            elif action == "DELETE":
+                deletes.append(path)
+            elif action == "MODIFY":
+                self.perform_modify(path, self._kind(path))
+        deletes.sort(key=lambda path: path.count(os.sep), reverse=True)
+        for path in deletes:
+            self.perform_delete(path)
+        try:
+            self._copy_files_batch(self._uploads)
+        finally:
+            self._uploads = []
+
+    async def _run(self):
         waiting_time = self.WAITING_TIME
-        while self._running:
-            if time.time() - self._ts > waiting_time:
-                q = self._q
-                if not q.empty():
-                    if not self._mpconnect():
-                        print("Could not connect to board! Retrying in 5 seconds")
-                        time.sleep(5)
+        idle_time = self.IDLE_TIME
+        q = self._q
+        mono = time.monotonic
+        sleep = asyncio.sleep
+        actions = []
+        while True:
+            try:
+                if not actions:
+                    # Sleep until an event arrives. While connected, wake up in time
+                    # to close an idle connection.
+                    timeout = None
+                    if self._is_open():
+                        timeout = max(0, idle_time - (mono() - self._last_activity))
+                    try:
+                        actions.append(await asyncio.wait_for(q.get(), timeout))
+                    except asyncio.TimeoutError:
+                        await self._blocking(self._mpdisconnect)
                         continue
-                    while not q.empty():
-                        try:
-                            action, params = q.get(False)
-                            if action == "CREATE":
-                                self.perform_create(params)
-                            elif action == "DELETE":
-                                self.perform_delete(params)
-                            elif action == "MOVE":
-                                self.perform_move(params[0], params[1])
-                            elif action == "MODIFY":
-                                self.perform_modify(params)
-                        except queue.Empty:
-                            pass
-                    q.task_done()
-                    self._mpdisconnect()
-            time.sleep(0.1)
+
+                # Wait until no new changes came in for waiting_time seconds
+                remaining = waiting_time - (mono() - self._ts)
+                while remaining > 0:
+                    await sleep(remaining)
+                    remaining = waiting_time - (mono() - self._ts)
+
+                while not q.empty():
+                    actions.append(q.get_nowait())
+                if self._overflow is not None:
+                    actions.extend((a, p) for p, a in self._overflow.items())
+                    self._overflow = None
+                # The debounce window of every queued modification has passed
+                self._last_event_ts = {}
+                # Actions are kept while the board is unreachable, so they must not
+                # grow beyond one per path
+                ops = self._collapse(actions)
+                actions = [(action, path) for path, action in ops.items()]
+
+                if not await self._blocking(self._mpconnect):
+                    print("Could not connect to board! Retrying in 5 seconds")
+                    await sleep(5)
+                    continue
+                try:
+                    await self._blocking(self._process, ops)
+                except _ConnectionLost:
+                    print(f"Lost connection to {self.port}! Retrying in 5 seconds")
+                    await sleep(5)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Keep synchronizing, but drop the changes that caused the error
+                print("Synchronizing failed, skipping these changes!")
+                traceback.print_exc()
+            actions = []
+            self._last_activity = mono()
+
+    async def _cancel(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            traceback.print_exc()
 
     def start_sync(self):
-        """Starts the synchronization. Non-blocking!"""
+        """Starts the synchronization. Non-blocking, but waits for the background
+        initialization and raises a RuntimeError if mpfshell could not be set up."""
+        self._shell()
+        self._task = self._loop.create_task(self._run())
+        self._worker.start()
         self.wd.start()
-        self._running = True
-        self.start()
 
     def stop_sync(self):
         """Stops the synchronization."""
         self.wd.stop()
-        self._running = False
+        self.wd.join()
+        asyncio.run_coroutine_threadsafe(self._cancel(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._worker.join(timeout=5)
+        if not self._worker.is_alive():
+            self._loop.close()
+        # Wait for an upload that is still running before closing the connection
+        self._executor.shutdown()
+        self._mpdisconnect()
 
 
 def parse_args():
@@ -208,8 +623,25 @@ def parse_args():
     parser.add_argument(
         "-p",
         "--port",
-        help="Serial port of the MicroPython board.",
-        default="/dev/tty.SLAB_USBtoUART",
+        help="Serial port of the MicroPython board. Multiple ports can be given to "
+        "synchronize several boards in parallel.",
+        default=["/dev/tty.SLAB_USBtoUART"],
+        nargs="+",
+    )
+    parser.add_argument(
+        "-b",
+        "--baud",
+        help="Baud rate of the serial connection. Default is 115200.",
+        default=115200,
+        type=int,
+    )
+    parser.add_argument(
+        "-i",
+        "--ignore",
+        help="Name of a file or folder that should not be synchronized. "
+        "Can be given multiple times.",
+        default=[],
+        action="append",
     )
     parser.add_argument(
         "-v",
@@ -225,15 +657,30 @@ def main():
     args = parse_args()
     if not args.folder:
         args.folder = os.getcwd()
-    mps = MPSync(folder=args.folder, port=args.port, verbose=args.verbose)
-    print(f"Start syncing folder '{args.folder}' to board at '{args.port}'")
-    mps.start_sync()
+    # Every board gets its own MPSync, so the uploads run in parallel
+    boards = [
+        MPSync(
+            folder=args.folder,
+            port=port,
+            baud=args.baud,
+            verbose=args.verbose,
+            ignore=args.ignore,
+        )
+        for port in dict.fromkeys(args.port)
+    ]
+    syncs = []
     try:
+        for mps in boards:
+            print(f"Start syncing folder '{args.folder}' to board at '{mps.port}'")
+            mps.start_sync()
+            syncs.append(mps)
         while True:
             time.sleep(0.1)
     except KeyboardInterrupt:
         pass
-    mps.stop_sync()
+    finally:
+        for mps in syncs:
+            mps.stop_sync()
 
 
 if __name__ == "__main__":